@@ -2,33 +2,24 @@ import argparse
 import sys
 import os
 import io
+import mmap
 import subprocess
+import shutil
 import time
-import timeit
 import tempfile
 import typing
-from operator import itemgetter
+import numba
+import numpy as np
+import pandas as pd
+from pandas.api.types import union_categoricals
 
 def get_header_info_of_file1(file1: io.IOBase, line: str, line_count: int, stderr) -> typing.List[int]:
-    try:
-        line = file1.readline()
-        if line == "":
-            print("Error: unexpected end of input on line {}".format(
-                line_count),
-                file=stderr)
-            sys.exit(100)
-    except OSError as err:
-        print("Error: failed to read line {} ({})".format(
-            line_count,
-            err.strerror),
+    line = file1.readline().decode()
+    if line == "":
+        print("Error: unexpected end of input on line {}".format(
+            line_count),
             file=stderr)
-        sys.exit(200)
-    except:
-        print("Error: failed to read line {} ({})".format(
-            line_count,
-            sys.exc_info()[0]),
-            file=stderr)
-        sys.exit(300)
+        sys.exit(100)
     return parse_line1_of_file1(line, line_count, stderr)
 
 def parse_line1_of_file1(line: str, line_count: int, stderr) -> typing.List[int]:
@@ -48,55 +39,34 @@ def parse_line1_of_file1(line: str, line_count: int, stderr) -> typing.List[int]
             file=stderr)
         sys.exit(1)
     if len(ints) != 6:
-        print("line {}: {}Error: expecting line to be six integers of the format:".format(
-            line_count,
-            line),
-            file=stderr)
-        print("# <x_count>, <y_count>, <z_count>, <x_parent_size>, <y_parent_size>, <z_parent_size>",
-            file=stderr)
+        message = "\n".join([
+            "line {}: {}Error: expecting line to be six integers of the format:".format(
+                line_count,
+                line),
+            "# <x_count>, <y_count>, <z_count>, <x_parent_size>, <y_parent_size>, <z_parent_size>"])
+        stderr.write(message + "\n")
         sys.exit(1)
     return ints
 
-def read_next_line_of_input(file, line_count, stderr):
-    try:
-        while True:
-            line = file.readline()
-            line_count += 1
-            if len(line) == 0:
-                break
-            elif line[0] == '#' or line[0] == '\n' or line[0] == '\r':
-                # Ignore comment lines and blank lines
-                continue
-            else:
-                break
-    except OSError as err:
-        print("Error: failed to read line {} ({})".format(
-            line_count,
-            err.strerror),
-            file=stderr)
-        sys.exit(200)
-    except:
-        print("Error: failed to read line {} ({})".format(
-            line_count,
-            sys.exc_info()[0]),
-            file=stderr)
-        sys.exit(300)
-    return line, line_count
+def rows(file):
+    # Yields each line of the text file that holds a block, with its line
+    # number, skipping comment and blank lines.
+    for line_count, line in enumerate(file, 1):
+        if line[:1] not in ("#", "\n", "\r"):
+            yield line, line_count
 
 def file_format_error_and_exit(line: str, line_count: int, stderr):
-    print("line {}: {}Error: expecting format '{}'".format(
+    stderr.write("line {}: {}Error: expecting format '{}'\n".format(
         line_count,
         line,
-        "x, y, z, sx, sy, sz, string"),
-        file=stderr)
+        "x, y, z, sx, sy, sz, string"))
     sys.exit(1)
 
-def parse_and_check_line_of_file1(x: int, y: int, z:int, line: str, line_count: int, stderr, domains: typing.Dict):
+def parse_and_check_line_of_file1(x: int, y: int, z:int, line: str, line_count: int, stderr):
     last_comma = line.rfind(",")
     if last_comma == -1:
         file_format_error_and_exit(line, line_count, stderr)
     domain = line[last_comma+1:].strip("' \n\r")
-    domains[domain] = domains.get(domain, 0) + 1
     try:
         ints = [int(i) for i in line[0:last_comma].split(',')]
     except ValueError as err:
@@ -155,6 +125,8 @@ def parse_line(
             err),
             file=stderr)
         sys.exit(1)
+    if len(ints) != 6:
+        file_format_error_and_exit(line, line_count, stderr)
     if ints[3] < 0 or ints[4] < 0 or ints[5] < 0:
         print("line {}: {}Error: expecting positive block sizes only".format(
             line_count,
@@ -169,6 +141,572 @@ def parse_line(
         sys.exit(1)
     return ints[0], ints[1], ints[2], ints[3], ints[4], ints[5], domain
 
+def check_line_of_file2(
+    line: str,
+    line_count: int,
+    z: int,
+    parent_size_x: int,
+    parent_size_y: int,
+    parent_size_z: int,
+    line_count_last_chunk_end: int,
+    stderr):
+    x2, y2, z2, xs2, ys2, zs2, domain = parse_line(
+        line,
+        line_count,
+        parent_size_x,
+        parent_size_y,
+        parent_size_z,
+        stderr)
+    if z2 < z:
+        # This block is from an earlier chunk and we mandate chunkwise
+        # processing => format error.
+        print("{}: {}Error: block z value lies in an earlier chunk, expected before line {}.".format(
+            line_count,
+            line,
+            line_count_last_chunk_end - 1),
+            file=stderr)
+        sys.exit(1)
+    elif x2 // parent_size_x != (x2 + xs2 - 1) // parent_size_x:
+        print("{}: {}Error: block crosses a parent block boundary in the x direction.".format(
+            line_count,
+            line),
+            file=stderr)
+        sys.exit(1)
+    elif y2 // parent_size_y != (y2 + ys2 - 1) // parent_size_y:
+        print("{}: {}Error: block crosses a parent block boundary in the y direction.".format(
+            line_count,
+            line),
+            file=stderr)
+        sys.exit(1)
+    elif z2 // parent_size_z != (z2 + zs2 - 1) // parent_size_z:
+        print("{}: {}Error: block crosses a parent block boundary in the z direction.".format(
+            line_count,
+            line),
+            file=stderr)
+        sys.exit(1)
+
+def crosses_parent_boundary(start: np.ndarray, size: np.ndarray, parent_size: int) -> np.ndarray:
+    # Returns which blocks cross a parent block boundary along one axis. Parent
+    # sizes are usually powers of two, in which case comparing the positions
+    # with the low bits masked off avoids two integer divides per block.
+    end = start + size - 1
+    if parent_size > 0 and parent_size & (parent_size - 1) == 0:
+        mask = ~(parent_size - 1)
+        return (start & mask) != (end & mask)
+    return start // parent_size != end // parent_size
+
+def find_line(file, row: int):
+    # Returns the text and line number of the given (zero based) block in the
+    # binary file. Only needed to report errors, so it simply rescans from the
+    # start. For a block past the end of the file the line is empty, and
+    # numbered as though reading went on a line per block past the last line.
+    file.seek(0)
+    text = io.TextIOWrapper(file)
+    for line, line_count in rows(text):
+        if row == 0:
+            break
+        row -= 1
+    else:
+        text.seek(0)
+        line, line_count = "", sum(1 for _ in text) + row + 1
+    text.detach()
+    return line, line_count
+
+def report_malformed_file(
+    file,
+    name: str,
+    parent_size_x: int,
+    parent_size_y: int,
+    parent_size_z: int,
+    err: Exception,
+    stderr):
+    # The bulk parser rejected the file, so find and report the first bad
+    # line by parsing it the slow way.
+    file.seek(0)
+    for line, line_count in rows(io.TextIOWrapper(file)):
+        parse_line(line, line_count, parent_size_x, parent_size_y, parent_size_z, stderr)
+    print("Error: failed to parse {} ({})".format(
+        name,
+        err),
+        file=stderr)
+    sys.exit(1)
+
+# Blocks are read in batches of this many lines at a time.
+BLOCKS_PER_READ = 1 << 20
+# Block model files can run to gigabytes, so read them through a larger buffer
+# than the default to cut down on the number of read calls.
+READ_BUFFER_SIZE = 1 << 20
+
+@numba.njit(cache=True)
+def copy_block_lines(data, out) -> int:
+    # Copies the lines of data that hold blocks to out, leaving out comment
+    # and blank lines just as rows() does, and returns the number of bytes
+    # copied. Like text mode, lines may end in any of \n, \r\n or \r.
+    # Returns -1 instead if a line has anything other than digits, signs and
+    # spaces in its six integer fields, since pandas would read values such
+    # as 7.0, 1e0 or True that int() rejects.
+    n = 0
+    start = 0
+    while start < len(data):
+        end = start
+        while end < len(data) and data[end] != ord("\n") and data[end] != ord("\r"):
+            end += 1
+        if end < len(data):
+            if data[end] == ord("\r") and end + 1 < len(data) and data[end + 1] == ord("\n"):
+                end += 1
+            end += 1
+        first = data[start]
+        if first != ord("#") and first != ord("\n") and first != ord("\r"):
+            commas = 0
+            i = start
+            while i < end and commas < 6:
+                c = data[i]
+                if c == ord(","):
+                    commas += 1
+                elif not (
+                        ord("0") <= c <= ord("9") or c == ord("+") or c == ord("-")
+                        or c == ord(" ") or c == ord("\t")
+                        or c == ord("\n") or c == ord("\r")):
+                    return -1
+                i += 1
+            out[n:n + end - start] = data[start:end]
+            n += end - start
+        start = end
+    return n
+
+class BlockLines(io.RawIOBase):
+    # A binary stream of the lines of the given binary stream that hold
+    # blocks. pandas would take a # anywhere on a line as the start of a
+    # comment, when only lines starting with one are comments, so they are
+    # filtered out here instead. The bulk of the work is done by the compiled
+    # copy_block_lines() over whole buffers of lines at a time.
+
+    def __init__(self, file):
+        self.file = file
+        self.partial = b""
+        self.lines = memoryview(b"")
+        self.eof = False
+
+    def readable(self) -> bool:
+        return True
+
+    def readinto(self, buffer) -> int:
+        while not self.lines and not self.eof:
+            data = self.partial + self.file.read(READ_BUFFER_SIZE)
+            if len(data) == len(self.partial):
+                # The end of the file, which may not end with a newline
+                self.eof = True
+                end = len(data)
+            else:
+                end = max(data.rfind(b"\n"), data.rfind(b"\r")) + 1
+            self.partial = data[end:]
+            data = np.frombuffer(data, dtype=np.uint8, count=end)
+            lines = np.empty_like(data)
+            n = copy_block_lines(data, lines)
+            if n == -1:
+                raise ValueError("expecting integers")
+            self.lines = memoryview(lines[:n]).cast("B")
+        n = min(len(buffer), len(self.lines))
+        buffer[:n] = self.lines[:n]
+        self.lines = self.lines[n:]
+        return n
+
+def read_blocks(file, chunksize: int, memory_map: bool = False):
+    # Yields the blocks in the rest of the binary file (or the file at the
+    # given path) as data frames of up to chunksize blocks each. Handing
+    # pandas the raw bytes lets its C parser convert each field directly
+    # without first decoding every line to a str. Comment and blank lines are
+    # skipped by BlockLines, while a line of just spaces is an error as it is
+    # to the line parser. Domains are read as categories since there are typically only
+    # a few distinct ones, so each is stored once and blocks refer to it by a
+    # small integer code. That also makes it cheap to strip the quotes and
+    # spaces around them just as the line parser does, since only the
+    # categories need stripping rather than every block. Nothing is read as
+    # missing, so an empty domain is the empty string like it is to the line
+    # parser, and an empty number is an error.
+    # The integers are read as 64 bit so out of range values are caught by
+    # the checks rather than wrapping around. With memory_map a path is
+    # mapped into memory and parsed in place.
+    if memory_map:
+        with open(file, "rb") as handle, \
+             mmap.mmap(handle.fileno(), 0, access=mmap.ACCESS_READ) as mapping:
+            yield from read_blocks(mapping, chunksize)
+        return
+    for blocks in pd.read_csv(
+        BlockLines(file),
+        header=None,
+        names=["x", "y", "z", "sx", "sy", "sz", "domain"],
+        dtype={
+            "x": np.int64, "y": np.int64, "z": np.int64,
+            "sx": np.int64, "sy": np.int64, "sz": np.int64,
+            "domain": "category"},
+        na_filter=False,
+        skip_blank_lines=False,
+        skipinitialspace=True,
+        quotechar="'",
+        engine="c",
+        chunksize=chunksize):
+        domains = blocks["domain"].cat
+        stripped = domains.categories.str.strip("' \n\r")
+        if not stripped.equals(domains.categories):
+            # Stripping can make categories the same, so recode the blocks
+            categories = stripped.unique()
+            codes = categories.get_indexer(stripped)[domains.codes]
+            blocks["domain"] = pd.Categorical.from_codes(
+                np.where(domains.codes == -1, -1, codes),
+                categories)
+        yield blocks
+
+def concat_blocks(frames):
+    # pd.concat falls back to plain strings when the domain categories of the
+    # frames differ, so merge the categories to keep the column categorical.
+    chunk = pd.concat(frames, ignore_index=True)
+    if len(frames) > 1:
+        chunk["domain"] = union_categoricals([frame["domain"] for frame in frames])
+    return chunk
+
+def chunks_of_file2(batches, parent_size_z: int):
+    # Regroups batches of blocks into chunks, yielding the number of the first
+    # block in each chunk along with the blocks themselves. A chunk ends at the
+    # first block whose z value lies beyond it, so by tracking the running
+    # maximum of z each chunk boundary is found with a binary search.
+    row = 0
+    chunk_end = parent_size_z
+    pending = []
+    for batch in batches:
+        z_max = np.maximum.accumulate(batch["z"].to_numpy())
+        start = 0
+        while len(z_max) and z_max[-1] >= chunk_end:
+            split = int(np.searchsorted(z_max, chunk_end))
+            pending.append(batch.iloc[start:split])
+            chunk = concat_blocks(pending)
+            yield row, chunk
+            row += len(chunk)
+            chunk_end += parent_size_z
+            start = split
+            pending = []
+        pending.append(batch.iloc[start:])
+    if pending:
+        chunk = concat_blocks(pending)
+        if len(chunk):
+            yield row, chunk
+
+def sub_block_cells(z: int, x_count: int, y_count: int, x2, y2, z2, xs2, ys2, zs2) -> np.ndarray:
+    # Returns the index into the slab starting at z, laid out in z, y, x order
+    # like file1, of every sub-block of the given blocks, block by block. The
+    # blocks are exploded in one go with array arithmetic rather than a
+    # Python loop building sub-block objects for every block.
+    volumes = xs2 * ys2 * zs2
+    # Number each sub-block within its block, then split that number into
+    # x, y and z offsets from the block's corner.
+    block_of = np.repeat(np.arange(len(volumes)), volumes)
+    index = np.arange(len(block_of)) - (np.cumsum(volumes) - volumes)[block_of]
+    xs_of = xs2[block_of]
+    area_of = xs_of * ys2[block_of]
+    dx = index % xs_of
+    dy = (index % area_of) // xs_of
+    dz = index // area_of
+    corners = ((z2 - z) * y_count + y2) * x_count + x2
+    return corners[block_of] + (dz * y_count + dy) * x_count + dx
+
+@numba.njit(cache=True)
+def first_mismatch(cover, domains2, domains1) -> int:
+    # Returns the index of the first cell of the slab that isn't covered by
+    # exactly one block of file2 with the same domain as file1, or -1 if the
+    # slab matches. Compiled so the comparison is a single native pass that
+    # stops at the first mismatch.
+    for i in range(len(domains1)):
+        if cover[i] != 1 or domains2[i] != domains1[i]:
+            return i
+    return -1
+
+def first_block_containing(x: int, y: int, z: int, x2, y2, z2, xs2, ys2, zs2) -> int:
+    # Returns the index of the first of the given blocks that contains the
+    # sub-block at x, y, z.
+    contains = (
+        (x2 <= x) & (x < x2 + xs2) &
+        (y2 <= y) & (y < y2 + ys2) &
+        (z2 <= z) & (z < z2 + zs2))
+    return int(contains.argmax())
+
+# Positions of every cell of a slab for each slab shape seen, see slab_indices().
+slab_positions = {}
+
+def slab_indices(x_count: int, y_count: int, z_size: int) -> typing.Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    # Returns the x, y and z position within the slab of every cell of a slab
+    # of the given shape, in z, y, x order like file1.
+    positions = slab_positions.get((x_count, y_count, z_size))
+    if positions is None:
+        z, y, x = np.indices((z_size, y_count, x_count), dtype=np.int32).reshape(3, -1)
+        positions = (x, y, z)
+        slab_positions[(x_count, y_count, z_size)] = positions
+    return positions
+
+def check_chunk(
+    z: int,
+    x_count: int,
+    y_count: int,
+    parent_size_x: int,
+    parent_size_y: int,
+    parent_size_z: int,
+    blocks2: typing.Tuple[np.ndarray, ...],
+    blocks1: typing.Tuple[np.ndarray, ...]):
+    # Checks a chunk of file2 against the matching slab of file1. Rather than
+    # reporting an error itself, returns a tuple describing the first one
+    # found for the caller to report from the lines of the files, or None if
+    # the chunk matches.
+    #
+    # blocks2 holds the x, y, z, sx, sy, sz columns of the chunk along with
+    # the domain codes translated to file1's categories (-1 for domains not in
+    # file1). blocks1 holds the x, y, z, sx, sy, sz columns of the slab and
+    # its domain codes.
+    x2, y2, z2, xs2, ys2, zs2, domains_of_blocks2 = blocks2
+    x1, y1, z1, xs1, ys1, zs1, domains1 = blocks1
+    # Check every block of the chunk at once, leaving the caller to report
+    # the first offending line exactly as a line by line check would.
+    bad = (
+        (xs2 < 0) | (ys2 < 0) | (zs2 < 0) |
+        (xs2 > parent_size_x) | (ys2 > parent_size_y) | (zs2 > parent_size_z) |
+        (z2 < z) |
+        crosses_parent_boundary(x2, xs2, parent_size_x) |
+        crosses_parent_boundary(y2, ys2, parent_size_y) |
+        crosses_parent_boundary(z2, zs2, parent_size_z))
+    if bad.any():
+        return ("file2", int(bad.argmax()))
+    outside = (x2 < 0) | (x2 + xs2 > x_count) | (y2 < 0) | (y2 + ys2 > y_count)
+    if outside.any():
+        return ("extra", int(outside.argmax()))
+    # file1 must hold unit blocks listed in z, y, x order
+    slab_x, slab_y, slab_z = slab_indices(x_count, y_count, parent_size_z)
+    n1 = len(domains1)
+    bad = (
+        (domains1 == -1) |
+        (xs1 != 1) | (ys1 != 1) | (zs1 != 1) |
+        (x1 != slab_x[:n1]) |
+        (y1 != slab_y[:n1]) |
+        (z1 != slab_z[:n1] + z))
+    if bad.any():
+        return ("file1", int(bad.argmax()))
+    # Rather than exploding the blocks into a list of sub-blocks and
+    # sorting it into file1's order, paint each block straight into
+    # a grid laid out like the slab of file1, counting how many blocks
+    # cover each cell. This does away with the sort, and the slab can
+    # then be compared cell by cell.
+    slab_size = len(slab_x)
+    cells = sub_block_cells(z, x_count, y_count, x2, y2, z2, xs2, ys2, zs2)
+    cover = np.bincount(cells, minlength=slab_size)
+    domains2 = np.full(slab_size, -1, dtype=np.int32)
+    domains2[cells] = np.repeat(domains_of_blocks2, xs2 * ys2 * zs2)
+    i = first_mismatch(cover, domains2, domains1)
+    if i != -1:
+        if cover[i] != 1:
+            return ("misplaced", i)
+        return ("domain", i, first_block_containing(
+            slab_x[i], slab_y[i], slab_z[i] + z, x2, y2, z2, xs2, ys2, zs2))
+    if cover[n1:].any():
+        i = n1 + int(cover[n1:].argmax())
+        return ("extra", first_block_containing(
+            slab_x[i], slab_y[i], slab_z[i] + z, x2, y2, z2, xs2, ys2, zs2))
+    return None
+
+def prewarm_file_cache(path: str):
+    # Reads the whole file and discards it so that it is in the OS page cache,
+    # meaning every timed run starts from the same cache state rather than the
+    # first one paying to read the input off disk.
+    with open(path, "rb", buffering=READ_BUFFER_SIZE) as file:
+        while file.read(READ_BUFFER_SIZE):
+            pass
+
+# Output of up to this many bytes is held in memory, beyond which it spills
+# over to a file.
+SPOOL_SIZE = 1 << 28
+
+def run_captured(
+    command: typing.List[str],
+    stdin_path: str,
+    stderr_path: str,
+    output: typing.BinaryIO,
+    prewarm: bool):
+    # Runs the command with its standard input and error redirected from and
+    # to the given files directly rather than through a shell, collecting its
+    # standard output through a pipe into the given binary file. Returns the
+    # exit status and the time taken in seconds, including draining the pipe.
+    # The time is measured in integer nanoseconds so short runs aren't lost to
+    # rounding. With prewarm the input is read into the page cache beforehand
+    # so that it is warm for every timed run.
+    if prewarm:
+        prewarm_file_cache(stdin_path)
+    with open(stdin_path, "rb") as stdin_file, \
+         open(stderr_path, "wb") as stderr_file:
+        tic = time.perf_counter_ns()
+        with subprocess.Popen(
+                command,
+                stdin=stdin_file,
+                stdout=subprocess.PIPE,
+                stderr=stderr_file,
+                bufsize=READ_BUFFER_SIZE) as process:
+            shutil.copyfileobj(process.stdout, output, READ_BUFFER_SIZE)
+        toc = time.perf_counter_ns()
+    return process.returncode, (toc - tic) / 1e9
+
+def check_block_models(file1, file2, name_f1: str, name_f2: str, log, stderr) -> typing.Tuple[int, int]:
+    # Checks that the block model in the binary file2 is equivalent to that
+    # in the binary file1, reporting the first difference found and exiting
+    # if not. Returns the number of blocks in each file in turn.
+    line_f1 = ""
+    line_count_f1 = 1
+    ints = get_header_info_of_file1(file1, line_f1, line_count_f1, stderr)
+    x_count = ints[0]
+    y_count = ints[1]
+    z_count = ints[2]
+    block_count_f1 = x_count * y_count * z_count
+    parent_size_x = ints[3]
+    parent_size_y = ints[4]
+    parent_size_z = ints[5]
+    log("...looking for {} blocks.", x_count * y_count * z_count)
+    # We now have sufficient info from file1 to start reading in the first
+    # chunk of file2. A chunk is all the blocks in a parent_size_z run of
+    # consecutive slices in z, which in file1 is always a slab of
+    # x_count * y_count * parent_size_z blocks.
+    slab_size = x_count * y_count * parent_size_z
+    slab_x, slab_y, slab_z = slab_indices(x_count, y_count, parent_size_z)
+    # file1 is only read through its handle for the header and to report
+    # errors. The blocks themselves are parsed straight out of a memory
+    # mapping of the file, which skips the header as a comment line.
+    slabs_f1 = read_blocks(name_f1, slab_size, memory_map=True)
+    chunks_f2 = chunks_of_file2(read_blocks(file2, BLOCKS_PER_READ), parent_size_z)
+    block_count_f2 = 0
+
+    def report_chunk_error(error, z: int, row_f2: int, slab):
+        # Reports the error found by check_chunk() and exits. Lines
+        # blamed by the bulk checks are parsed again by the line
+        # parser so that they are reported as it would, falling
+        # back to a format error should it accept them.
+        kind = error[0]
+        if kind == "file2":
+            line_count_f2_last_chunk_end = find_line(file2, row_f2)[1] if z > 0 else 0
+            line_f2, line_count_f2 = find_line(file2, row_f2 + error[1])
+            check_line_of_file2(
+                line_f2,
+                line_count_f2,
+                z,
+                parent_size_x,
+                parent_size_y,
+                parent_size_z,
+                line_count_f2_last_chunk_end,
+                stderr)
+            file_format_error_and_exit(line_f2, line_count_f2, stderr)
+        elif kind == "file1":
+            i = error[1]
+            line_f1, line_count_f1 = find_line(file1, z * x_count * y_count + i)
+            parse_line(line_f1, line_count_f1, 1, 1, 1, stderr)
+            parse_and_check_line_of_file1(
+                slab_x[i],
+                slab_y[i],
+                slab_z[i] + z,
+                line_f1,
+                line_count_f1,
+                stderr)
+            file_format_error_and_exit(line_f1, line_count_f1, stderr)
+        elif kind == "misplaced":
+            i = error[1]
+            print("Error: block {},{},{} missing, duplicated or should appear earlier in the output.".format(
+                slab_x[i],
+                slab_y[i],
+                slab_z[i] + z),
+                file=stderr)
+        elif kind == "domain":
+            i = error[1]
+            line_f2, line_count_f2 = find_line(file2, row_f2 + error[2])
+            domain = parse_line(
+                line_f2,
+                line_count_f2,
+                parent_size_x,
+                parent_size_y,
+                parent_size_z,
+                stderr)[6]
+            print("Error: block {},{},{},'{}' on line {} should be '{}'.".format(
+                slab_x[i],
+                slab_y[i],
+                slab_z[i] + z,
+                domain,
+                line_count_f2,
+                slab["domain"].iloc[i]),
+                file=stderr)
+        elif kind == "extra":
+            print("Error: {} specifies more blocks than {} from line {} onwards.".format(
+                name_f2,
+                name_f1,
+                find_line(file2, row_f2 + error[1])[1]),
+                file=stderr)
+        sys.exit(1)
+
+    # Chunks are read, parsed and checked in turn so only one chunk
+    # of the model is held in memory at a time.
+    for z in range(0, z_count, parent_size_z):
+        log("...reading chunk {} of {}", z // parent_size_z + 1, z_count // parent_size_z)
+        try:
+            row_f2, chunk = next(chunks_f2, (None, None))
+        except (ValueError, OverflowError) as err:
+            report_malformed_file(file2, name_f2, parent_size_x, parent_size_y, parent_size_z, err, stderr)
+        if chunk is None:
+            line_f2, line_count_f2 = find_line(file2, block_count_f2)
+            if z == 0:
+                print("Error: unexpected end of input on line {}".format(
+                    line_count_f2),
+                    file=stderr)
+                sys.exit(100)
+            file_format_error_and_exit(line_f2, line_count_f2, stderr)
+        block_count_f2 += len(chunk)
+        try:
+            slab = next(slabs_f1, None)
+        except (ValueError, OverflowError) as err:
+            report_malformed_file(file1, name_f1, 1, 1, 1, err, stderr)
+        if slab is None:
+            # file1 has run out of blocks
+            slab = pd.DataFrame({
+                column: np.empty(0, dtype=np.int64)
+                for column in ("x", "y", "z", "sx", "sy", "sz")})
+            slab["domain"] = pd.Categorical([])
+            categories1 = pd.Index([])
+        else:
+            categories1 = slab["domain"].cat.categories
+        codes2 = chunk["domain"].cat.codes.to_numpy()
+        # The domains of file2 are translated to file1's codes
+        blocks2 = (
+            chunk["x"].to_numpy(),
+            chunk["y"].to_numpy(),
+            chunk["z"].to_numpy(),
+            chunk["sx"].to_numpy(),
+            chunk["sy"].to_numpy(),
+            chunk["sz"].to_numpy(),
+            np.where(
+                codes2 == -1,
+                -1,
+                categories1.get_indexer(chunk["domain"].cat.categories)[codes2]))
+        blocks1 = (
+            slab["x"].to_numpy(),
+            slab["y"].to_numpy(),
+            slab["z"].to_numpy(),
+            slab["sx"].to_numpy(),
+            slab["sy"].to_numpy(),
+            slab["sz"].to_numpy(),
+            slab["domain"].cat.codes.to_numpy())
+        log("...checking chunk {} of {}", z // parent_size_z + 1, z_count // parent_size_z)
+        error = check_chunk(
+            z,
+            x_count,
+            y_count,
+            parent_size_x,
+            parent_size_y,
+            parent_size_z,
+            blocks2,
+            blocks1)
+        if error is not None:
+            report_chunk_error(error, z, row_f2, slab)
+    return block_count_f1, block_count_f2
+
+
 parser = argparse.ArgumentParser(
     formatter_class=argparse.RawDescriptionHelpFormatter,
     epilog=
@@ -219,229 +757,149 @@ parser.add_argument(
     "--verbose",
     help="print additional output to see details and progress",
     action="store_true")
-args = parser.parse_args()
-strnull = open(os.devnull, 'w')
-stdout = sys.stdout
-stderr = sys.stderr
-stdvout = sys.stderr if args.verbose else strnull
-
-if not os.path.isfile(args.path_to_item_under_test):
-    print("Script or execuitable not found at '{}'".format(
-        args.path_to_item_under_test),
-        file=stderr)
-    sys.exit(10)
-if not (
-    args.path_to_item_under_test.endswith(".py") or
-    args.path_to_item_under_test.endswith(".exe")):
-    print("'{}' must be a Python (.py) or executable (.exe) file".format(
-        args.path_to_item_under_test),
-        file=stderr)
-    sys.exit(11)
-if not os.path.isfile(args.path_to_block_model_input_csv):
-    print("Input block model file not found at '{}'".format(
-        args.path_to_block_model_input_csv),
-        file=stderr)
-    sys.exit(12)
-
-with tempfile.TemporaryDirectory() as tmpdir:
-    if args.speed:
-        print("Using temporary directory '{}'".format(tmpdir),file=stdvout)
-        print("Measuring straight stdin to stdout speed...", file=stdvout)
-        command = [
-            "cmd.exe",
-            "/c",
-            r"std2std.exe",
-            "<", args.path_to_block_model_input_csv,
-            ">", "{}/out0.csv".format(tmpdir),
-            "2>", "{}/err0.txt".format(tmpdir),
-            ]
-        print("...doing warm up run", file=stdvout)
-        completed_process = subprocess.run(command)
-        if completed_process.returncode != 0:
-            print("Baseline speed measurement process failed", file=stderr)
-            sys.exit(13)
-        print("...done", file=stdvout)
-        print("...doing timed run", file=stdvout)
-        tic = timeit.default_timer()
-        completed_process = subprocess.run(command)
-        toc = timeit.default_timer()
-        if completed_process.returncode != 0:
-            print("Baseline speed measurement process failed", file=stderr)
-            sys.exit(13)
-        baseline_time = toc - tic
-        print("...done in {:.3f}s".format(baseline_time), file=stdvout)
-    print("Running the item under test...", file=stdvout)
-    command_head = ["cmd.exe", "/c"]
-    if args.path_to_item_under_test.endswith(".py"):
-        command_body = [sys.executable, args.path_to_item_under_test]
-    else:
-        command_body = [args.path_to_item_under_test]
-    command_tail = [
-        "<", args.path_to_block_model_input_csv,
-        ">", "{}/out.csv".format(tmpdir),
-        "2>", "{}/err.txt".format(tmpdir)]
-    command = command_head + command_body + command_tail
-    print('..."{}"'.format(" ".join(command[0:-4])), file=stdvout)
-    tic = timeit.default_timer()
-    completed_process = subprocess.run(command)
-    toc = timeit.default_timer()
-    if completed_process.returncode != 0:
-        print("Error: {} exited with exit status {}.".format(
-            args.path_to_item_under_test,
-            completed_process.returncode),
+def main():
+    args = parser.parse_args()
+    stdout = sys.stdout
+    stderr = sys.stderr
+
+    def log(message: str, *values):
+        # Prints progress to stderr in verbose mode. The message is only
+        # formatted with the values when it is actually going to be shown.
+        if args.verbose:
+            print(message.format(*values) if values else message, file=stderr)
+
+    if not os.path.isfile(args.path_to_item_under_test):
+        print("Script or execuitable not found at '{}'".format(
+            args.path_to_item_under_test),
             file=stderr)
-        print("Console showing stderr looks like...\n> {}".format(
-            " ".join(command[:-4])),
+        sys.exit(10)
+    if not (
+        args.path_to_item_under_test.endswith(".py") or
+        args.path_to_item_under_test.endswith(".exe")):
+        print("'{}' must be a Python (.py) or executable (.exe) file".format(
+            args.path_to_item_under_test),
             file=stderr)
-        with open("{}/err.txt".format(tmpdir), "r") as errors:
-            print(errors.read(), file=stderr)
-        sys.exit(14)
-    item_under_test_time = toc - tic
-    print("...done in {:.3f}s".format(item_under_test_time), file=stdvout)
-    print("Analysing the output of the item under test...", file=stdvout)
-    with open(args.path_to_block_model_input_csv, "r") as file1, \
-         open("{}/out.csv".format(tmpdir), "r") as file2:
-        line_f1 = ""
-        line_count_f1 = 1
-        ints = get_header_info_of_file1(file1, line_f1, line_count_f1, stderr)
-        x_count = ints[0]
-        y_count = ints[1]
-        z_count = ints[2]
-        block_count_f1 = x_count * y_count * z_count
-        parent_size_x = ints[3]
-        parent_size_y = ints[4]
-        parent_size_z = ints[5]
-        print("...looking for {} blocks.".format(x_count * y_count * z_count),
-            file=stdvout)
-        # We now have sufficient info from file1 to start reading in the first
-        # chunk of file2. A chunk is all the blocks in a parent_size_z run of
-        # consecutive slices in z.
-        line_count_f2 = 0
-        line_f2, line_count_f2 = read_next_line_of_input(file2, line_count_f2, stderr)
-        if line_f2 == "":
-            print("Error: unexpected end of input on line {}".format(
-                line_count_f2),
-                file=stderr)
-            sys.exit(100)
-        line_count_f2_last_chunk_end = 0
-        block_count_f2 = 0
-        for z in range(0, z_count, parent_size_z):
-            print("...reading chunk {} of {}".format(
-                z // parent_size_z + 1, z_count // parent_size_z),
-                file=stdvout)
-            chunk_list = []
-            while True:
-                x2, y2, z2, xs2, ys2, zs2, domain = parse_line(
-                    line_f2,
-                    line_count_f2,
-                    parent_size_x,
-                    parent_size_y,
-                    parent_size_z,
-                    stderr)
-                if z2 < z:
-                    # This block is from an earlier chunk and we mandate chunkwise
-                    # processing => format error.
-                    print("{}: {}Error: block z value lies in an earlier chunk, expected before line {}.".format(
-                        line_count_f2,
-                        line_f2,
-                        line_count_f2_last_chunk_end - 1),
-                        file=stderr)
-                    sys.exit(1)
-                elif x2 // parent_size_x != (x2 + xs2 - 1) // parent_size_x:
-                    print("{}: {}Error: block crosses a parent block boundary in the x direction.".format(
-                        line_count_f2,
-                        line_f2),
-                        file=stderr)
-                    sys.exit(1)
-                elif y2 // parent_size_y != (y2 + ys2 - 1) // parent_size_y:
-                    print("{}: {}Error: block crosses a parent block boundary in the y direction.".format(
-                        line_count_f2,
-                        line_f2),
-                        file=stderr)
-                    sys.exit(1)
-                elif z2 // parent_size_z != (z2 + zs2 - 1) // parent_size_z:
-                    print("{}: {}Error: block crosses a parent block boundary in the z direction.".format(
-                        line_count_f2,
-                        line_f2),
-                        file=stderr)
-                    sys.exit(1)
-                elif z2 > z + parent_size_z - 1:
-                    # This block is from the next chunk, so don't process it yet
-                    # and assume we have come to the end of the current chunk.
-                    line_count_f2_last_chunk_end = line_count_f2
-                    break
-                # Explode the block into sub-blocks and add each to the chunk list
-                block_count_f2 += 1
-                for sz in range(zs2):
-                    for sy in range(ys2):
-                        for sx in range(xs2):
-                            chunk_list.append([x2+sx, y2+sy, z2+sz, domain, line_count_f2])
-                # Now grab the next line and continue the loop
-                line_f2, line_count_f2 = read_next_line_of_input(file2, line_count_f2, stderr)
-                if line_f2 == "":
-                    # We have reached the end of the file and now should process
-                    # the last chunk.
-                    break
-            # Sort the data by x, y and z in that order:
-            chunk_list.sort(key=itemgetter(2,1,0))
-            # Now compare it line by line with file1 over the slice range z:z+zsf
-            print("...checking chunk {} of {}".format(
-                z // parent_size_z + 1, z_count // parent_size_z),
-                file=stdvout)
-            for e in chunk_list:
-                line_f1, line_count_f1 = read_next_line_of_input(
+        sys.exit(11)
+    if not os.path.isfile(args.path_to_block_model_input_csv):
+        print("Input block model file not found at '{}'".format(
+            args.path_to_block_model_input_csv),
+            file=stderr)
+        sys.exit(12)
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        err0_path = os.path.join(tmpdir, "err0.txt")
+        err_path = os.path.join(tmpdir, "err.txt")
+        if args.speed:
+            log("Using temporary directory '{}'", tmpdir)
+            log("Measuring straight stdin to stdout speed...")
+            command = [r"std2std.exe"]
+
+            def run_baseline() -> float:
+                # The baseline's output is drained through a pipe just like
+                # that of the item under test, but straight into a discard
+                # sink so that its time doesn't include spilling an input
+                # sized output to disk. Exits if the baseline can't be run or
+                # fails.
+                try:
+                    with open(os.devnull, "wb") as output:
+                        returncode, baseline_time = run_captured(
+                            command,
+                            args.path_to_block_model_input_csv,
+                            err0_path,
+                            output,
+                            True)
+                except OSError:
+                    returncode = None
+                if returncode != 0:
+                    print("Baseline speed measurement process failed", file=stderr)
+                    sys.exit(13)
+                return baseline_time
+
+            log("...doing warm up run")
+            run_baseline()
+            log("...done")
+            log("...doing timed run")
+            baseline_time = run_baseline()
+            log("...done in {:.3f}s", baseline_time)
+        log("Running the item under test...")
+        if args.path_to_item_under_test.endswith(".py"):
+            command = [sys.executable, args.path_to_item_under_test]
+        else:
+            command = [args.path_to_item_under_test]
+        console = " ".join(command + ["<", args.path_to_block_model_input_csv])
+        log('..."{}"', console)
+        # The output is kept in memory while it is small and spills over to a
+        # file in the temporary directory once it outgrows SPOOL_SIZE.
+        output = tempfile.SpooledTemporaryFile(max_size=SPOOL_SIZE, dir=tmpdir)
+        try:
+            returncode, item_under_test_time = run_captured(
+                command,
+                args.path_to_block_model_input_csv,
+                err_path,
+                output,
+                args.speed)
+            status = "exited with exit status {}".format(returncode)
+        except OSError as err:
+            # Such as an executable that isn't one
+            returncode = None
+            status = "could not be run ({})".format(err.strerror)
+        if returncode != 0:
+            with open(err_path, "r") as errors:
+                message = "\n".join([
+                    "Error: {} {}.".format(
+                        args.path_to_item_under_test,
+                        status),
+                    "Console showing stderr looks like...\n> {}".format(
+                        console),
+                    errors.read()])
+            stderr.write(message + "\n")
+            sys.exit(14)
+        log("...done in {:.3f}s", item_under_test_time)
+        log("Analysing the output of the item under test...")
+        output.seek(0)
+        name_f1 = args.path_to_block_model_input_csv
+        name_f2 = "the output of {}".format(args.path_to_item_under_test)
+        try:
+            with open(name_f1, "rb", buffering=READ_BUFFER_SIZE) as file1, \
+                 output as file2:
+                block_count_f1, block_count_f2 = check_block_models(
                     file1,
-                    line_count_f1,
-                    stderr)
-                if line_f1 == "":
-                    print("Error: {} specifies more blocks than {} from line {} onwards.".format(
-                        file2.name,
-                        file1.name,
-                        e[4]),
-                        file=stderr)
-                    sys.exit(1)
-                x1, y1, z1, xs1, ys1, zs1, domain1 = parse_line(
-                    line_f1,
-                    line_count_f1,
-                    1,
-                    1,
-                    1,
+                    file2,
+                    name_f1,
+                    name_f2,
+                    log,
                     stderr)
-                if e[0] != x1 or e[1] != y1 or e[2] != z1:
-                    print("Error: block {},{},{} missing, duplicated or should appear earlier in the output.".format(
-                        x1,
-                        y1,
-                        z1),
-                        file=stderr)
-                    sys.exit(1)
-                if e[3] != domain1:
-                    print("Error: block {},{},{},'{}' on line {} should be '{}'.".format(
-                        x1,
-                        y1,
-                        z1,
-                        e[3],
-                        e[4],
-                        domain1),
-                        file=stderr)
-                    sys.exit(1)
-        print("...equivalence = 100%", file=stdvout)
-        print("-----------", file=stdvout)
+        except OSError as err:
+            print("Error: failed to read the block models ({})".format(
+                err.strerror),
+                file=stderr)
+            sys.exit(200)
+        except ValueError as err:
+            # Such as input that isn't valid text
+            print("Error: failed to read the block models ({})".format(
+                err),
+                file=stderr)
+            sys.exit(300)
+        log("...equivalence = 100%")
+        log("-----------")
         compression = (block_count_f1 - block_count_f2) / block_count_f1
-        print("Compression = {:6.2f}%  ({} blocks down from {} blocks)".format(
+        log("Compression = {:6.2f}%  ({} blocks down from {} blocks)",
             compression*100,
             block_count_f2,
-            block_count_f1), file=stdvout)
+            block_count_f1)
         if args.speed:
             speed = baseline_time / item_under_test_time
-            print("      Speed = {:6.2f}%  ({:.0f} blocks per second, raw io is {:.0f})".format(
+            log("      Speed = {:6.2f}%  ({:.0f} blocks per second, raw io is {:.0f})",
                 speed*100,
                 block_count_f1/item_under_test_time,
-                block_count_f1/baseline_time),
-                file=stdvout)
-        print("-----------", file=stdvout)
-        print("exit status is 0", file=stdvout)
-        print("stdout is:", file=stdvout)
+                block_count_f1/baseline_time)
+        log("-----------")
+        log("exit status is 0")
+        log("stdout is:")
         # Print final results to stdout
         print("{}".format(compression), file=stdout)
         if args.speed:
             print("{}".format(speed), file=stdout)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,259 @@
+import os
+import subprocess
+import sys
+import tempfile
+import unittest
+
+RUNNER = os.path.join(os.path.dirname(os.path.abspath(__file__)), "runner.py")
+
+
+class RunnerTestCase(unittest.TestCase):
+    # Runs runner.py over a small input model of unit blocks with an item
+    # under test that outputs the given lines. By default the model is two
+    # chunks of 2x2x2 parent blocks.
+    x_count, y_count, z_count = 4, 4, 4
+    parent_size = 2
+
+    def domain(self, x, y, z):
+        return "sea" if z < 2 else "rock"
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmpdir.cleanup)
+        self.lines = [
+            "{}, {}, {}, 1, 1, 1, '{}'".format(x, y, z, self.domain(x, y, z))
+            for z in range(self.z_count)
+            for y in range(self.y_count)
+            for x in range(self.x_count)]
+        self.model_path = os.path.join(self.tmpdir.name, "model.csv")
+        self.write_model(self.lines)
+
+    def write_model(self, lines):
+        with open(self.model_path, "w") as model:
+            model.write("# {}, {}, {}, {}, {}, {}\n".format(
+                self.x_count,
+                self.y_count,
+                self.z_count,
+                self.parent_size,
+                self.parent_size,
+                self.parent_size))
+            model.write("".join(line + "\n" for line in lines))
+
+    def run_runner(self, lines):
+        output_path = os.path.join(self.tmpdir.name, "output.csv")
+        with open(output_path, "w") as output:
+            output.write("".join(line + "\n" for line in lines))
+        item_path = os.path.join(self.tmpdir.name, "item.py")
+        with open(item_path, "w") as item:
+            item.write("import sys\n")
+            item.write("with open({!r}) as output:\n".format(output_path))
+            item.write("    sys.stdout.write(output.read())\n")
+        return subprocess.run(
+            [sys.executable, RUNNER, item_path, self.model_path],
+            capture_output=True,
+            text=True)
+
+    def assertAccepted(self, lines, compression=0.0):
+        result = self.run_runner(lines)
+        self.assertEqual(result.returncode, 0, result.stderr)
+        self.assertAlmostEqual(float(result.stdout), compression)
+
+    def assertRejected(self, lines, message):
+        result = self.run_runner(lines)
+        self.assertNotEqual(result.returncode, 0)
+        self.assertIn(message, result.stderr)
+
+
+class OutputMutationTest(RunnerTestCase):
+    # Checks whether a copy of the model with one line changed is accepted or
+    # reported.
+
+    def mutated(self, x, y, z, line):
+        lines = list(self.lines)
+        lines[(z * self.y_count + y) * self.x_count + x] = line
+        return lines
+
+    def test_unchanged(self):
+        self.assertAccepted(self.lines)
+
+    def test_coordinate_beyond_32_bits(self):
+        # 4294967299 wraps around to 3 in 32 bits
+        self.assertRejected(
+            self.mutated(3, 0, 0, "4294967299, 0, 0, 1, 1, 1, 'sea'"),
+            "specifies more blocks than")
+
+    def test_coordinate_beyond_64_bits(self):
+        self.assertRejected(
+            self.mutated(3, 0, 0, "99999999999999999999, 0, 0, 1, 1, 1, 'sea'"),
+            "Error: failed to parse")
+
+    def test_integral_floats(self):
+        self.assertRejected(
+            self.mutated(1, 0, 0, "1.0, 0, 0, 1, 1, 1, 'sea'"),
+            "line 2: 1.0, 0, 0, 1, 1, 1, 'sea'\nError: invalid literal for int()")
+        self.assertRejected(
+            self.mutated(1, 0, 0, "1, 0, 0, 1e0, 1, 1, 'sea'"),
+            "line 2: 1, 0, 0, 1e0, 1, 1, 'sea'\nError: invalid literal for int()")
+        self.assertRejected(
+            self.mutated(1, 0, 0, "True, 0, 0, 1, 1, 1, 'sea'"),
+            "Error: invalid literal for int()")
+
+    def test_spaces_around_domain(self):
+        self.assertAccepted(self.mutated(0, 0, 0, "0, 0, 0, 1, 1, 1, 'sea' "))
+        self.assertAccepted(self.mutated(0, 0, 0, "0, 0, 0, 1, 1, 1, ' sea'"))
+
+    def test_empty_domain(self):
+        self.assertRejected(
+            self.mutated(3, 0, 0, "3, 0, 0, 1, 1, 1, "),
+            "Error: block 3,0,0,'' on line 4 should be 'sea'.")
+        self.assertRejected(
+            self.mutated(3, 0, 0, "3, 0, 0, 1, 1, 1, ''"),
+            "Error: block 3,0,0,'' on line 4 should be 'sea'.")
+
+    def test_missing_domain(self):
+        self.assertRejected(
+            self.mutated(3, 0, 0, "3, 0, 0, 1, 1, 1"),
+            "line 4: 3, 0, 0, 1, 1, 1\nError: expecting format")
+
+    def test_comment_and_blank_lines(self):
+        lines = list(self.lines)
+        lines[5:5] = ["# a comment", "", "#"]
+        self.assertAccepted(lines)
+        self.assertRejected(
+            self.mutated(3, 0, 0, "  "),
+            "line 4:   \nError: expecting format")
+
+    def test_hash_in_domain(self):
+        # Only lines starting with # are comments
+        self.lines = [
+            line.replace("'sea'", "#000").replace("'rock'", "#fff")
+            for line in self.lines]
+        self.write_model(self.lines)
+        self.assertAccepted(self.lines)
+        self.assertRejected(
+            self.mutated(3, 0, 0, "3, 0, 0, 1, 1, 1, #000#fff"),
+            "Error: block 3,0,0,'#000#fff' on line 4 should be '#000'.")
+
+    def test_hash_after_domain(self):
+        self.assertRejected(
+            self.mutated(3, 0, 0, "3, 0, 0, 1, 1, 1, sea#WRONG"),
+            "Error: block 3,0,0,'sea#WRONG' on line 4 should be 'sea'.")
+        self.assertRejected(
+            self.mutated(3, 0, 0, "3, 0, 0, 1, 1, 1, 'sea'  # note"),
+            "Error: block 3,0,0,'sea'  # note' on line 4 should be 'sea'.")
+
+    def test_missing_chunk(self):
+        self.assertRejected(self.lines[:32], "line 33: Error: expecting format")
+        self.assertRejected([], "Error: unexpected end of input on line 1")
+
+    def test_item_not_executable(self):
+        item_path = os.path.join(self.tmpdir.name, "item.exe")
+        with open(item_path, "w") as item:
+            item.write("not a program\n")
+        result = subprocess.run(
+            [sys.executable, RUNNER, item_path, self.model_path],
+            capture_output=True,
+            text=True)
+        self.assertEqual(result.returncode, 14)
+        self.assertIn("Error: {} could not be run".format(item_path), result.stderr)
+        self.assertIn("Console showing stderr looks like...", result.stderr)
+
+    def test_baseline_not_found(self):
+        # Without std2std.exe on the path the speed can't be measured
+        item_path = os.path.join(self.tmpdir.name, "item.py")
+        with open(item_path, "w") as item:
+            item.write("pass\n")
+        result = subprocess.run(
+            [sys.executable, RUNNER, "-s", item_path, self.model_path],
+            capture_output=True,
+            text=True,
+            env=dict(os.environ, PATH=self.tmpdir.name))
+        self.assertEqual(result.returncode, 13)
+        self.assertIn("Baseline speed measurement process failed", result.stderr)
+
+    def test_header_not_text(self):
+        with open(self.model_path, "r+b") as model:
+            model.write(b"#\xff")
+        result = self.run_runner(self.lines)
+        # Exit statuses are taken modulo 256 outside Windows
+        self.assertIn(result.returncode, (300, 300 % 256))
+        self.assertIn("Error: failed to read the block models", result.stderr)
+
+
+class CompressedOutputTest(RunnerTestCase):
+    # Checks output made of blocks larger than a unit against a model of two
+    # chunks of 3x3x3 parent blocks, a parent size that isn't a power of two.
+    # The upper chunk has a parent block of two domains at x >= 3.
+    x_count, y_count, z_count = 6, 6, 6
+    parent_size = 3
+
+    def domain(self, x, y, z):
+        if z < 3:
+            return "sea"
+        return "rock" if x < 4 else "sand"
+
+    def compressed(self):
+        # 1x3x3 and 2x3x3 blocks at x = 0 and 1 don't cross the boundary at 3,
+        # though they would were it masked off as for a power of two.
+        lines = [
+            "0, 0, 0, 1, 3, 3, 'sea'",
+            "1, 0, 0, 2, 3, 3, 'sea'",
+            "3, 0, 0, 3, 3, 3, 'sea'",
+            "0, 3, 0, 3, 3, 3, 'sea'",
+            "3, 3, 0, 3, 3, 3, 'sea'"]
+        for y in (0, 3):
+            lines.extend([
+                "0, {}, 3, 3, 3, 3, 'rock'".format(y),
+                "3, {}, 3, 1, 3, 3, 'rock'".format(y),
+                "4, {}, 3, 2, 3, 3, 'sand'".format(y)])
+        return lines
+
+    def replaced(self, start, stop, *lines):
+        compressed = self.compressed()
+        compressed[start:stop] = lines
+        return compressed
+
+    def test_compressed(self):
+        self.assertAccepted(self.compressed(), 1 - 11 / 216)
+        self.assertAccepted(self.lines)
+
+    def test_parent_boundary_crossings(self):
+        self.assertRejected(
+            self.replaced(2, 3, "3, 0, 0, 2, 3, 3, 'sea'", "5, 0, 0, 2, 3, 3, 'sea'"),
+            "4: 5, 0, 0, 2, 3, 3, 'sea'\n"
+            "Error: block crosses a parent block boundary in the x direction.")
+        self.assertRejected(
+            self.replaced(3, 4, "0, 2, 0, 3, 2, 3, 'sea'"),
+            "4: 0, 2, 0, 3, 2, 3, 'sea'\n"
+            "Error: block crosses a parent block boundary in the y direction.")
+        self.assertRejected(
+            self.replaced(0, 2, "0, 0, 0, 3, 3, 1, 'sea'", "0, 0, 1, 3, 3, 3, 'sea'"),
+            "2: 0, 0, 1, 3, 3, 3, 'sea'\n"
+            "Error: block crosses a parent block boundary in the z direction.")
+
+    def test_duplicated_block(self):
+        # Reported at the first sub-block covered twice, rather than at the
+        # one after it as the line by line check did
+        self.assertRejected(
+            self.replaced(5, 6, "0, 0, 3, 3, 3, 3, 'rock'", "0, 0, 3, 3, 3, 3, 'rock'"),
+            "Error: block 0,0,3 missing, duplicated or should appear earlier in the output.")
+
+    def test_overlapping_blocks(self):
+        self.assertRejected(
+            self.replaced(6, 7, "3, 0, 3, 2, 3, 3, 'rock'"),
+            "Error: block 4,0,3 missing, duplicated or should appear earlier in the output.")
+
+    def test_missing_block(self):
+        self.assertRejected(
+            self.replaced(6, 7),
+            "Error: block 3,0,3 missing, duplicated or should appear earlier in the output.")
+
+    def test_domain_mismatch_inside_block(self):
+        # The corner of the block matches but the next sub-block along doesn't
+        self.assertRejected(
+            self.replaced(6, 8, "3, 0, 3, 3, 3, 3, 'rock'"),
+            "Error: block 4,0,3,'rock' on line 7 should be 'sand'.")
+
+
+if __name__ == "__main__":
+    unittest.main()